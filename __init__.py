@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
 from os import path as os_path
+from cStringIO import StringIO
+from base64 import b64encode
 
 from django.utils.encoding import force_unicode
 from django.utils.functional import curry
@@ -10,11 +12,18 @@ from django.core.files import File
 from django.core.files.images import get_image_dimensions
 
 import PIL
+import PIL.Image
+import PIL.ImageFile
+import PIL.JpegImagePlugin
+
+from imagewallet.image import shared, has_alpha, make_placeholder, placeholder_image
 
 
 ORIGINAL_FORMAT = 'original'
 # max block size for jpeg save in PIL
 MAXBLOCK = 3200 * 2000
+# max number of encodings while searching quality for max_file_size filter
+QUALITY_SEARCH_STEPS = 7
 
 
 class Wallet(object):
@@ -23,20 +32,40 @@ class Wallet(object):
     image_types_extensions = {
         'PNG':  'png',
         'JPEG': 'jpg',
+        'WEBP': 'webp',
     }
     # Original Image, stored after saving or loaded from disk
     _loaded_original = False
+    # File of original image, opened by wallet
+    _original_file = None
 
     def __init__(self, formats, pattern=None, original_image_type=None,
-            storage=None):
+            storage=None, max_pixels=None, max_original_size=None,
+            originals_cache=None, placeholder=None, lazy_formats=False,
+            placeholder_size=0):
         """
         Pattern is a string with 2 replaces: "size" and "extension".
         original_image_type is type of saved original image.
+        max_pixels limits number of pixels in decoded image on save.
+        Original images larger than max_original_size reduced on save.
+        originals_cache is optional OriginalsCache instance, used for
+        loading original images.
+        placeholder is string with tiny version of original image.
+        With lazy_formats get_url doesn't check and create missing formats,
+        they should be created on request (see imagewallet.views).
+        If placeholder_size given, placeholder not more than this size
+        on each side is computed on save.
         """
         self.formats = formats
         self._pattern = pattern
         self.original_image_type = original_image_type
         self.storage = storage or default_storage
+        self.max_pixels = max_pixels
+        self.max_original_size = max_original_size
+        self.originals_cache = originals_cache
+        self.placeholder = placeholder
+        self.lazy_formats = lazy_formats
+        self.placeholder_size = placeholder_size
 
         if original_image_type is not None and not pattern:
             raise ValueError('For saved files pattern is required')
@@ -46,11 +75,28 @@ class Wallet(object):
                 ' Given pattern: %s' % pattern)
 
     def __unicode__(self):
-        if self:
+        if self and self.placeholder:
+            return u'%s;%s;%s' % (self._pattern, self.original_image_type,
+                self.placeholder)
+        elif self:
             return u'%s;%s' % (self._pattern, self.original_image_type)
         else:
             return u''
 
+    @staticmethod
+    def parse(value):
+        """
+        Parses string representation of saved wallet.
+        Returns pattern, original image type and placeholder.
+        """
+        placeholder = None
+        pattern, original_image_type = value.rsplit(';', 1)
+        # image types never contain colon, unlike placeholders
+        if ':' in original_image_type:
+            placeholder = original_image_type
+            pattern, original_image_type = pattern.rsplit(';', 1)
+        return pattern, original_image_type, placeholder
+
     def set_pattern(self, value):
         if self:
             raise ValueError("Can not change pattern for saved wallet. Delete first.")
@@ -88,10 +134,74 @@ class Wallet(object):
         if not self:
             return None
         if not self._loaded_original:
-            image = self.storage.open(self.get_path(ORIGINAL_FORMAT))
-            self._loaded_original = PIL.Image.open(image)
+            if self.originals_cache is not None:
+                self._loaded_original = self.originals_cache.get(
+                    self.get_original_cache_key(), self.decode_original)
+            else:
+                self._loaded_original = self.open_original(
+                    self.get_path(ORIGINAL_FORMAT))
         return self._loaded_original
 
+    def open_original(self, path):
+        """
+        Opens image from storage as original. Images from local storages
+        opened by file name: it is cheaper and allows PIL to map raw images
+        to memory. Otherwise storage file is kept to be closed on release.
+        """
+        local_path = self.get_local_path(path)
+        if local_path is not None:
+            return PIL.Image.open(local_path)
+        self._original_file = self.storage.open(path)
+        return PIL.Image.open(self._original_file)
+
+    def decode_original(self):
+        """
+        Returns fully decoded original image. File is closed after decoding.
+        """
+        try:
+            image = self.open_original(self.get_path(ORIGINAL_FORMAT))
+            image.load()
+        finally:
+            self.release_original()
+        return image
+
+    def get_original_cache_key(self):
+        return (self.storage, self.get_path(ORIGINAL_FORMAT),
+            self.original_image_type)
+
+    def release_original(self):
+        """
+        Frees loaded original image and closes its file, if wallet opened it.
+        Original will be loaded again on demand.
+        """
+        self._loaded_original = False
+        self.close_original_file()
+
+    def close_original_file(self):
+        """
+        Closes file of original image, if wallet opened it. Loaded image
+        doesn't need file anymore.
+        """
+        if self._original_file is not None:
+            self._original_file.close()
+            self._original_file = None
+
+    def limit_original(self, image):
+        """
+        Reduces image, which going to be original, to max_original_size.
+        Raises ValueError for images with more than max_pixels pixels.
+        """
+        if self.max_original_size:
+            resize = filters.Resize(self.max_original_size)
+            if all(resize.size):
+                # jpeg decoder can skip unnecessary data for large images
+                image.draft(image.mode, tuple(resize.size))
+        if self.max_pixels and image.size[0] * image.size[1] > self.max_pixels:
+            raise ValueError("Image is too large: %sx%s." % image.size)
+        if self.max_original_size:
+            image = resize(image)
+        return image
+
     def save(self, image):
         """
         Loads new image to wallet.
@@ -108,8 +218,7 @@ class Wallet(object):
             raise ValueError('Pattern string should contain %%(size)s replace. Given pattern: %s' % self._pattern)
 
         if isinstance(image, basestring):
-            image = self.storage.open(image)
-            image = PIL.Image.open(image)
+            image = self.open_original(image)
         elif isinstance(image, (file, File)):
             image = PIL.Image.open(image)
         elif isinstance(image, PIL.Image.Image):
@@ -117,13 +226,26 @@ class Wallet(object):
         else:
             raise ValueError("Argument of this type is not supported.")
 
-        self._loaded_original = image
+        # type should be taken before any changes
+        original_image_type = self.get_image_type(ORIGINAL_FORMAT, image.format)
+
+        try:
+            try:
+                self._loaded_original = self.limit_original(image)
+            except ValueError:
+                self.release_original()
+                raise
+
+            self.original_image_type = original_image_type
 
-        self.original_image_type = self.get_image_type(ORIGINAL_FORMAT,
-            self._loaded_original.format)
+            # process original image, it is fully loaded after this
+            self._loaded_original = self.process_format(ORIGINAL_FORMAT, save=True)
+        finally:
+            self.close_original_file()
 
-        # process original image
-        self._loaded_original = self.process_format(ORIGINAL_FORMAT, save=True)
+        if self.placeholder_size:
+            self.placeholder = make_placeholder(self._loaded_original,
+                self.placeholder_size)
 
         return self._loaded_original
 
@@ -137,46 +259,103 @@ class Wallet(object):
         if not image:
             return image
 
+        # Given image can be used by others (loaded original for example).
+        # Filters work with shared copy and make real copy only before
+        # changing pixels in place, so each format holds at most two frames.
+        image = shared(image)
+
         for filter in self.formats[format]:
             if callable(filter):
                 image = filter(image)
 
         if save:
-            save_params = image.info
+            image_type = self.get_image_type(format)
+            if image_type == 'JPEG' and image.mode not in PIL.JpegImagePlugin.RAWMODE:
+                image = image.convert('RGB')
+            elif image_type == 'WEBP' and image.mode not in ('RGB', 'RGBA'):
+                # webp encoder supports only truecolor images
+                image = image.convert('RGBA' if has_alpha(image) else 'RGB')
+
+            max_file_size = image.info.get('_filter_max_file_size')
+            if (max_file_size is not None and image_type in ('JPEG', 'WEBP')
+                    and not image.info.get('lossless')):
+                data = self.encode_to_size(image, image_type, image.info,
+                    max_file_size)
+            else:
+                data = self.encode(image, image_type, image.info)
 
             # Save empty file to ensure path is exists
             self.storage.save(self.get_path(format), ContentFile(''))
             file = self.storage.open(self.get_path(format), mode='wb')
             try:
-                image_type = self.get_image_type(format)
-                if image_type == 'JPEG' and image.mode not in PIL.JpegImagePlugin.RAWMODE:
-                    image = image.convert('RGB')
-
-                try:
-                    # Try save image with big block size
-                    OLD_MAXBLOCK = PIL.ImageFile.MAXBLOCK
-                    PIL.ImageFile.MAXBLOCK = MAXBLOCK
-                    image.save(file, format=image_type, **save_params)
-                except IOError:
-                    # Else remove all options affected expected block size
-                    if 'optimize' in save_params:
-                        del save_params['optimize']
-                    if 'progression' in save_params:
-                        del save_params['progression']
-                    if 'progressive' in save_params:
-                        del save_params['progressive']
-                    image.save(file, format=image_type, **save_params)
-                finally:
-                    PIL.ImageFile.MAXBLOCK = OLD_MAXBLOCK
-
+                file.write(data)
             finally:
                 file.close()
         return image
 
+    def encode(self, image, image_type, params):
+        """
+        Returns encoded image data. Options affected expected block size
+        removed, if image can not be saved with them.
+        """
+        params = dict(params)
+        OLD_MAXBLOCK = PIL.ImageFile.MAXBLOCK
+        try:
+            # Try save image with big block size
+            PIL.ImageFile.MAXBLOCK = MAXBLOCK
+            buffer = StringIO()
+            image.save(buffer, format=image_type, **params)
+        except IOError:
+            # Else remove all options affected expected block size
+            for option in ('optimize', 'progression', 'progressive'):
+                params.pop(option, None)
+            buffer = StringIO()
+            image.save(buffer, format=image_type, **params)
+        finally:
+            PIL.ImageFile.MAXBLOCK = OLD_MAXBLOCK
+        return buffer.getvalue()
+
+    def encode_to_size(self, image, image_type, params, max_file_size):
+        """
+        Returns image encoded with highest quality, not greater than given
+        in params, which fits max_file_size. Search starts from quality
+        found for previous image. If nothing fits, the smallest result
+        returned.
+        """
+        low, high = 1, params.get('quality', 95)
+        quality = high
+        best = None
+        for step in xrange(QUALITY_SEARCH_STEPS):
+            data = self.encode(image, image_type, dict(params, quality=quality))
+            if len(data) <= max_file_size.size:
+                best, best_quality = data, quality
+                low = quality + 1
+            else:
+                high = quality - 1
+            if low > high:
+                break
+            hint = max_file_size.quality
+            if step == 0 and hint is not None and low <= hint <= high:
+                quality = hint
+            else:
+                quality = (low + high) // 2
+
+        if best is None:
+            return data
+        max_file_size.quality = best_quality
+        return best
+
     def process_all_formats(self):
-        for format in self.formats:
-            if format != ORIGINAL_FORMAT:
-                self.process_format(format, save=True)
+        """
+        Process and save all not-original formats. Original image released
+        after all, because it is not needed anymore in most cases.
+        """
+        try:
+            for format in self.formats:
+                if format != ORIGINAL_FORMAT:
+                    self.process_format(format, save=True)
+        finally:
+            self.release_original()
 
     def copy(self, wallet):
         """
@@ -187,6 +366,7 @@ class Wallet(object):
         if not wallet:
             return
         self.original_image_type = wallet.original_image_type
+        self.placeholder = wallet.placeholder
         _from = wallet.get_path(ORIGINAL_FORMAT)
         _to = self.get_path(ORIGINAL_FORMAT)
         self.storage.save(_to, wallet.storage.open(_from))
@@ -200,8 +380,11 @@ class Wallet(object):
         for format in self.formats:
             path = self.get_path(format)
             self.storage.delete(path)
+        if self.originals_cache is not None:
+            self.originals_cache.delete(self.get_original_cache_key())
         self.original_image_type = None
-        self._loaded_original = False
+        self.placeholder = None
+        self.release_original()
 
     def clean(self, format):
         """
@@ -217,24 +400,66 @@ class Wallet(object):
         " TODO: cache this"
         if not self:
             return (None, None)
-        path = self.get_path(format)
-        if format != ORIGINAL_FORMAT and not self.storage.exists(path):
+        if self.needs_processing(format):
             image = self.process_format(format, save=True)
             return image.size
-        else:
-            return get_image_dimensions(self.storage.open(path))
+        return self.read_size(format)
+
+    def read_size(self, format):
+        """
+        Reads dimensions of existing image of format from file header.
+        """
+        path = self.get_path(format)
+        local_path = self.get_local_path(path)
+        if local_path is not None:
+            # reads only header, without storage file overhead
+            return get_image_dimensions(local_path)
+        file = self.storage.open(path)
+        try:
+            return get_image_dimensions(file)
+        finally:
+            file.close()
+
+    def needs_processing(self, format):
+        """
+        Returns True for not-original formats, which are not created yet.
+        """
+        return (format != ORIGINAL_FORMAT
+            and not self.storage.exists(self.get_path(format)))
 
     def get_url(self, format):
         # url returns only for existing images
         if self:
-            path = self.get_path(format)
             # if image not found, it created
-            if format != ORIGINAL_FORMAT and not self.storage.exists(path):
+            if not self.lazy_formats and self.needs_processing(format):
                 self.process_format(format, save=True)
-            return self.storage.url(path)
+            return self.storage.url(self.get_path(format))
         else:
             return None
 
+    @property
+    def placeholder_url(self):
+        """
+        Data url of placeholder image. Can be inlined in templates
+        without any storage access.
+        """
+        if not self.placeholder:
+            return None
+        buffer = StringIO()
+        placeholder_image(self.placeholder).save(buffer, format='PNG')
+        return 'data:image/png;base64,' + b64encode(buffer.getvalue())
+
+    @property
+    def placeholder_color(self):
+        """
+        Average color of placeholder in css notation.
+        """
+        if not self.placeholder:
+            return None
+        color = placeholder_image(self.placeholder).resize((1, 1),
+            PIL.Image.ANTIALIAS).getpixel((0, 0))
+        return '#%02x%02x%02x' % color
+
     def get_path(self, format):
         if not self._pattern:
             return None
@@ -242,6 +467,16 @@ class Wallet(object):
         extension = self.image_types_extensions.get(image_type)
         return self._pattern % {'size': format, 'extension': extension}
 
+    def get_local_path(self, path):
+        """
+        Returns file system path for storage path or None for not local
+        storages.
+        """
+        try:
+            return self.storage.path(path)
+        except NotImplementedError:
+            return None
+
     def get_image_type(self, format, original_image_type=None):
         if format not in self.formats:
             raise AttributeError("%s has no format %s" %
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+Wallet operations, running in background threads. Each function returns
+multiprocessing AsyncResult, so callers can start many operations and wait
+for results later with get(). Storage checks run in io pool, filters and
+encoding in separate cpu pool, so slow storage doesn't block processing.
+"""
+
+import threading
+import weakref
+from contextlib import contextmanager
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+from imagewallet import ORIGINAL_FORMAT
+from imagewallet.fields import FieldWallet
+
+
+IO_WORKERS = 8
+CPU_WORKERS = cpu_count()
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+# wallet -> [lock for loading original, number of operations using it]
+_wallets = weakref.WeakKeyDictionary()
+_wallets_lock = threading.Lock()
+
+
+def _get_pool(name, workers):
+    with _pools_lock:
+        if name not in _pools:
+            _pools[name] = ThreadPool(workers)
+        return _pools[name]
+
+
+def io_pool():
+    return _get_pool('io', IO_WORKERS)
+
+
+def cpu_pool():
+    return _get_pool('cpu', CPU_WORKERS)
+
+
+@contextmanager
+def _decoded_original(wallet):
+    """
+    Decodes original of wallet once for all concurrent operations with
+    this wallet, so they can process formats in parallel. Original is
+    released after last of them.
+    """
+    with _wallets_lock:
+        state = _wallets.setdefault(wallet, [threading.Lock(), 0])
+        state[1] += 1
+    try:
+        with state[0]:
+            original = wallet.load_original()
+            if original:
+                original.load()
+        yield
+    finally:
+        with _wallets_lock:
+            state[1] -= 1
+            if not state[1]:
+                del _wallets[wallet]
+                wallet.release_original()
+
+
+def _process_format(wallet, format):
+    with _decoded_original(wallet):
+        return cpu_pool().apply(wallet.process_format, (format,), {'save': True})
+
+
+def _get_url(wallet, format):
+    if not wallet:
+        return None
+    if not wallet.lazy_formats and wallet.needs_processing(format):
+        _process_format(wallet, format)
+    return wallet.storage.url(wallet.get_path(format))
+
+
+def _get_size(wallet, format):
+    if not wallet:
+        return (None, None)
+    if wallet.needs_processing(format):
+        return _process_format(wallet, format).size
+    return wallet.read_size(format)
+
+
+def _process_all_formats(wallet):
+    if not wallet:
+        return
+    formats = [format for format in wallet.formats if format != ORIGINAL_FORMAT]
+    with _decoded_original(wallet):
+        cpu_pool().map(lambda format: wallet.process_format(format, save=True),
+            formats)
+
+
+def get_url(wallet, format):
+    " Same as wallet.get_url(format). "
+    return io_pool().apply_async(_get_url, (wallet, format))
+
+
+def get_urls(wallets, format):
+    " Result is list of urls of given format for each wallet. "
+    return io_pool().map_async(lambda wallet: _get_url(wallet, format), wallets)
+
+
+def get_size(wallet, format):
+    " Same as wallet.get_size(format). "
+    return io_pool().apply_async(_get_size, (wallet, format))
+
+
+def save(wallet, image):
+    """
+    Same as wallet.save(image), but model instance of field wallet is never
+    saved: pool threads should not open database connections. Caller
+    should save instance after result is ready.
+    """
+    kwargs = {'save': False} if isinstance(wallet, FieldWallet) else {}
+    return cpu_pool().apply_async(wallet.save, (image,), kwargs)
+
+
+def process_all_formats(wallet):
+    " Same as wallet.process_all_formats(), but formats processed in parallel. "
+    return io_pool().apply_async(_process_all_formats, (wallet,))
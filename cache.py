@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+import threading
+from collections import OrderedDict
+
+from imagewallet.image import image_memory
+
+
+class OriginalsCache(object):
+    """
+    Thread-safe LRU cache of decoded original images, limited by memory
+    size in bytes. One instance can be shared by many fields, so formats
+    of one image generated in different requests decode original once.
+    Cached images should never be changed in place.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+        # locks for keys which are loading now
+        self._loading = {}
+
+    def get(self, key, load):
+        """
+        Returns cached image for key. Not cached image is loaded by load()
+        call. Concurrent calls for one key wait for single load.
+        """
+        with self._lock:
+            image = self._images.pop(key, None)
+            if image is not None:
+                # move to the end as most recently used
+                self._images[key] = image
+                return image
+            key_lock = self._loading.setdefault(key, threading.Lock())
+
+        try:
+            with key_lock:
+                with self._lock:
+                    image = self._images.get(key)
+                if image is None:
+                    image = load()
+                    self.put(key, image)
+        finally:
+            with self._lock:
+                self._loading.pop(key, None)
+        return image
+
+    def put(self, key, image):
+        memory = image_memory(image)
+        if memory > self.max_size:
+            # image will evict everything and will not be stored anyway
+            return
+        with self._lock:
+            self._delete(key)
+            self._images[key] = image
+            self.size += memory
+            while self.size > self.max_size:
+                self._delete(next(iter(self._images)))
+
+    def delete(self, key):
+        with self._lock:
+            self._delete(key)
+
+    def clear(self):
+        with self._lock:
+            self._images.clear()
+            self.size = 0
+
+    def _delete(self, key):
+        image = self._images.pop(key, None)
+        if image is not None:
+            self.size -= image_memory(image)
@@ -1,9 +1,13 @@
 # -*- coding: utf-8 -*-
 
 import os
+import re
 import datetime
 import random
+from itertools import islice
+from multiprocessing.pool import ThreadPool
 
+from django.db import router, transaction
 from django.db.models.fields.files import FileField
 from django.core.files import File
 from django.utils.encoding import force_unicode, smart_str
@@ -11,15 +15,32 @@ from django.utils.encoding import force_unicode, smart_str
 from imagewallet import Wallet, Filter, ORIGINAL_FORMAT
 
 
+# atomic appeared in Django 1.6, commit_on_success removed in 1.8
+atomic = getattr(transaction, 'atomic', None) or transaction.commit_on_success
+
+
 class FieldWallet(Wallet):
     def __init__(self, instance, field, *args, **kwargs):
         super(FieldWallet, self).__init__(field.formats, storage=field.storage,
-            *args, **kwargs)
+            max_pixels=field.max_pixels,
+            max_original_size=field.max_original_size,
+            originals_cache=field.originals_cache,
+            lazy_formats=field.lazy_formats,
+            placeholder_size=field.placeholder_size, *args, **kwargs)
         self.instance = instance
         self.field = field
 
+    def fit_placeholder(self):
+        """
+        Drops placeholder, if wallet value with it is too long for field.
+        """
+        max_length = self.field.max_length
+        if self.placeholder and max_length and len(unicode(self)) > max_length:
+            self.placeholder = None
+
     def save(self, image, save=True):
         super(FieldWallet, self).save(image)
+        self.fit_placeholder()
         if self.field.process_all_formats:
             self.process_all_formats()
         if save:
@@ -34,6 +55,7 @@ class FieldWallet(Wallet):
         self.pattern = self.field.generate_filename(self.instance,
             wallet.get_path(ORIGINAL_FORMAT))
         super(FieldWallet, self).copy(wallet)
+        self.fit_placeholder()
 
     def delete(self, save=True):
         super(FieldWallet, self).delete()
@@ -53,12 +75,14 @@ class WalletDescriptor(object):
         if isinstance(value, basestring) or value is None:
             pattern = None
             format = None
+            placeholder = None
             if value:
                 try:
-                    pattern, format = value.rsplit(';', 1)
+                    pattern, format, placeholder = field.attr_class.parse(value)
                 except ValueError:
                     pass
-            wallet = field.attr_class(instance, field, pattern, format)
+            wallet = field.attr_class(instance, field, pattern, format,
+                placeholder=placeholder)
             instance.__dict__[field.name] = wallet
         # value uploaded from form
         elif isinstance(value, File):
@@ -93,7 +117,9 @@ class WalletField(FileField):
     random_sings = 12
 
     def __init__(self, verbose_name=None, name=None, upload_to='', storage=None,
-                 formats={}, process_all_formats=False, **kwargs):
+                 formats={}, process_all_formats=False, max_pixels=None,
+                 max_original_size=None, originals_cache=None,
+                 lazy_formats=False, placeholder_size=0, **kwargs):
         kwargs.setdefault('max_length', 255)
         unique = kwargs.pop('unique', False)
         # set upload_to to empty string to prevent wrong handle
@@ -111,6 +137,11 @@ class WalletField(FileField):
         }
         self.formats.update(formats)
         self.process_all_formats = process_all_formats
+        self.max_pixels = max_pixels
+        self.max_original_size = max_original_size
+        self.originals_cache = originals_cache
+        self.lazy_formats = lazy_formats
+        self.placeholder_size = placeholder_size
         self.attr_class.populate_formats(self.formats.keys())
 
     def pre_save(self, model_instance, add):
@@ -145,11 +176,32 @@ class WalletField(FileField):
             for _ in xrange(self.random_sings)])
         return hash + u'_%(size)s.%(extension)s'
 
+    def parse_filename(self, path):
+        """
+        Reverse of get_filename. Returns pattern and format for path of any
+        image of wallet or None if path can't be generated by this field.
+        """
+        if os.path.isabs(path) or '..' in path.split('/'):
+            return None
+        if path.startswith('./'):
+            path = path[2:]
+        match = re.match(r'^((?:.*/)?)([%s]{%d})_([^/]+)\.(\w+)$' % (
+            self.random_chars, self.random_sings), path)
+        if not match:
+            return None
+        dir, hash, format, extension = match.groups()
+        if format not in self.formats:
+            return None
+        return dir + hash + u'_%(size)s.%(extension)s', format
+
     def generate_filename(self, instance, filename):
         """
         generate_filename for wallet is more intelligent then for files.
         """
         dir = self.get_directory_name(instance)
+        if dir == os.curdir:
+            # empty upload_to, storage urls don't have "./" prefix
+            dir = ''
         filename = os.path.basename(filename or '')
         while True:
             file = os.path.join(dir, self.get_filename(filename))
@@ -160,6 +212,85 @@ class WalletField(FileField):
                 break
         return file
 
+    def bulk_save(self, items, workers=4, batch_size=100):
+        """
+        Saves images for many instances at once. items is iterable of
+        (instance, image) pairs, image can be anything FieldWallet.save
+        accepts. Instances should be already saved to database.
+        Images processed by pool of workers, so no more than workers
+        originals are in memory at once. Field values written to database
+        in one transaction per batch, other fields are not saved.
+        Returns list of (instance, exception) pairs for failed items.
+        Images of failed items are deleted.
+        """
+        items = iter(items)
+        failures = []
+        pool = ThreadPool(workers)
+        try:
+            while True:
+                batch = list(islice(items, batch_size))
+                if not batch:
+                    break
+                saved = []
+                for instance, error in pool.imap_unordered(self._bulk_save_item, batch):
+                    if error is None:
+                        saved.append(instance)
+                    else:
+                        failures.append((instance, error))
+                failures.extend(self._bulk_write(saved))
+        finally:
+            pool.close()
+            pool.join()
+        return failures
+
+    def _bulk_save_item(self, item):
+        instance, image = item
+        wallet = self.attr_class(instance, self)
+        try:
+            if isinstance(image, basestring):
+                filename = image
+            else:
+                filename = getattr(image, 'name', None)
+            wallet.pattern = self.generate_filename(instance, filename)
+            wallet.save(image, save=False)
+        except Exception as error:
+            if wallet:
+                wallet.delete(save=False)
+            return instance, error
+        finally:
+            # instances can live long after batch, don't keep originals
+            wallet.release_original()
+        instance.__dict__[self.name] = wallet
+        return instance, None
+
+    def _bulk_write(self, instances):
+        """
+        Writes field values of instances to database in one transaction.
+        Returns list of (instance, exception) pairs for not written
+        instances. Their images are deleted.
+        """
+        failures = []
+        if not instances:
+            return failures
+        model = self.model
+        using = router.db_for_write(model)
+        manager = model._default_manager.using(using)
+        try:
+            with atomic(using=using):
+                for instance in instances:
+                    updated = manager.filter(pk=instance.pk).update(
+                        **{self.attname: self.pre_save(instance, False)})
+                    if not updated:
+                        failures.append((instance, model.DoesNotExist(
+                            "%s with pk %r not found." % (model.__name__,
+                                instance.pk))))
+        except Exception as error:
+            # whole transaction rolled back
+            failures = [(instance, error) for instance in instances]
+        for instance, error in failures:
+            getattr(instance, self.name).delete(save=False)
+        return failures
+
     def delete_file(self, instance, sender, **kwargs):
         # connected to post_delete signal
         # do nothing
@@ -6,7 +6,7 @@ from PIL.ImageColor import getrgb
 from PIL.ImageFilter import BLUR, CONTOUR, DETAIL, EDGE_ENHANCE, EDGE_ENHANCE_MORE, EMBOSS
 from PIL.ImageFilter import FIND_EDGES, SMOOTH, SMOOTH_MORE, SHARPEN
 
-from imagewallet.image import paste_composite, PALETTE_MODES
+from imagewallet.image import paste_composite, writable, place, has_alpha, PALETTE_MODES
 
 
 " Size method. Result image will be not more then given size"
@@ -177,14 +177,7 @@ class Resize(object):
                             raise TypeError('align format not supported')
                 new_height = requested_height
             
-            if image.mode in PALETTE_MODES:
-                bg = Image.new(image.mode, (new_width, new_height), image.info.get('transparency'))
-                bg.putpalette(image.getpalette())
-            else:
-                bg = Image.new(image.mode, (new_width, new_height), image.info.get('_filter_background_color', (0, 0, 0, 0)))
-            bg.paste(image, (offset_x, offset_y))
-            bg.info = image.info
-            image = bg
+            image = place(image, (new_width, new_height), (offset_x, offset_y))
 
         return image
 
@@ -212,11 +205,12 @@ def crop(image, size, align=('50%', '50%')):
         if size[i] >= image.size[i]:
             size[i] = image.size[i]
             continue
+        if align[i] is False or align[i] is None:
+            # int(False) is 0, so check it before
+            offset[i] = size[i] - image.size[i]
+            continue
         try:
             int(align[i])
-        except TypeError:
-            # False или None
-            offset[i] = size[0] - image.size[i]
         except ValueError:
             # с процентами
             a = float(align[i].rstrip('%'))
@@ -225,16 +219,7 @@ def crop(image, size, align=('50%', '50%')):
             # число
             offset[i] = int(align[i])
 
-    if image.mode in PALETTE_MODES:
-        bg = Image.new(image.mode, size, image.info.get('transparency'))
-        bg.putpalette(image.getpalette())
-    else:
-        bg = Image.new(image.mode, size, image.info.get('_filter_background_color', (0, 0, 0, 0)))
-
-    bg.paste(image, tuple(offset))
-    bg.info = image.info
-    image = bg
-    return image
+    return place(image, size, offset)
 
 
 def background(image, color):
@@ -244,30 +229,28 @@ def background(image, color):
                 if not isinstance(color, tuple):
                     color = getrgb(color)
                 
+                image = writable(image)
                 trans = image.info['transparency']
                 del image.info['transparency']
-                
+
                 palette = image.getpalette()
                 palette[trans * 3 + 0] = color[0]
                 palette[trans * 3 + 1] = color[1]
                 palette[trans * 3 + 2] = color[2]
                 image.putpalette(palette)
  
-        else:
-            bg = Image.new(image.mode, image.size, color)
-            bg.info = image.info
-            
-            if image.mode in ('RGBA', 'LA'):
-                if isinstance(color, tuple) and len(color) == 4:
-                    # semitransparent background
-                    paste_composite(bg, image)
-                else:
-                    # solid background
-                    bg = bg.convert(image.mode[:-1])
-                    bg.paste(image.convert(image.mode[:-1]), (0, 0), image)
+        elif image.mode in ('RGBA', 'LA'):
+            if isinstance(color, tuple) and len(color) == 4:
+                # semitransparent background
+                bg = Image.new(image.mode, image.size, color)
+                paste_composite(bg, image)
             else:
-                bg.paste(image, (0, 0))
+                # solid background, created in result mode without alpha
+                bg = Image.new(image.mode[:-1], image.size, color)
+                bg.paste(image, (0, 0), image)
+            bg.info = image.info
             image = bg
+        # images without alpha fully cover background, nothing to do
 
     image.info['_filter_background_color'] = color
     return image
@@ -282,6 +265,8 @@ def ambilight(image, size, scale=0.9, blur=5, crop=4):
 
 
 def convert(image, format):
+    if image.mode == format:
+        return image
     return image.convert(format)
 
 
@@ -296,6 +281,13 @@ def filter(image, filter, strength=1):
 
 
 def colorize(image, color='#fff', alpha=0.5):
+    if alpha == 0:
+        return image
+    if 0 < alpha <= 1:
+        # same as blending with solid image, but in place and with small mask
+        image = writable(image)
+        image.paste(color, None, Image.new('L', image.size, int(round(alpha * 255))))
+        return image
     return Image.blend(image, Image.new(image.mode, image.size, color), alpha)
 
 
@@ -317,3 +309,33 @@ def optimize(image):
     image.info['optimize'] = True
     return image
 
+
+class MaxFileSize(object):
+    def __init__(self, size):
+        """
+        JPEG and WebP only. Image will be saved with highest quality, which
+        fits given size in bytes. Quality given by quality filter is upper
+        bound. Quality found for last image used as starting point.
+        """
+        self.size = size
+        self.quality = None
+
+    def __call__(self, image):
+        image.info['_filter_max_file_size'] = self
+        return image
+
+max_file_size = MaxFileSize
+
+
+def lossless(image, only_transparent=False):
+    " WebP only. Lossless compression, optionally only for transparent images."
+    if not only_transparent or has_alpha(image):
+        image.info['lossless'] = True
+    return image
+
+
+def effort(image, method):
+    " WebP only. Encoder effort from 0 (fast) to 6 (slow, but smaller files)."
+    image.info['method'] = method
+    return image
+
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+from base64 import b64encode, b64decode
+
 from PIL import Image, ImageMath
 
 PALETTE_MODES = ('P',)
@@ -17,4 +19,110 @@ def paste_composite(original, paste):
 
     original.paste(paste, (0, 0), blending_chanel)
     original.putalpha(alpha_chanel)
-    del image_alpha, alpha_chanel, blending_chanel
\ No newline at end of file
+    del image_alpha, alpha_chanel, blending_chanel
+
+def shared(image):
+    """
+    Returns new image object which shares pixels with given image, but has
+    own info. Such images marked readonly: filters must call writable()
+    before any changes in place.
+    """
+    image.load()
+    result = image._new(image.im)
+    result.readonly = 1
+    return result
+
+
+def writable(image):
+    """
+    Returns image which pixels can be changed in place. It is image itself,
+    if image is not shared with others, or copy.
+    """
+    if image.readonly:
+        return image.copy()
+    return image
+
+
+def place(image, size, offset):
+    """
+    Returns image of given size with given image placed at offset.
+    Uncovered area filled with background color.
+    """
+    size = tuple(size)
+    box = (-offset[0], -offset[1], size[0] - offset[0], size[1] - offset[1])
+    if (box[0] >= 0 and box[1] >= 0
+            and box[2] <= image.size[0] and box[3] <= image.size[1]):
+        # image covers whole area, background not needed
+        result = image.crop(box)
+        result.load()
+    else:
+        if image.mode in PALETTE_MODES:
+            result = Image.new(image.mode, size, image.info.get('transparency'))
+            result.putpalette(image.getpalette())
+        else:
+            result = Image.new(image.mode, size,
+                image.info.get('_filter_background_color', (0, 0, 0, 0)))
+        result.paste(image, tuple(offset))
+    result.info = image.info.copy()
+    return result
+
+
+def image_memory(image):
+    """
+    Approximate memory size of decoded image in bytes.
+    """
+    if image.mode in ('1', 'L', 'P'):
+        depth = 1
+    elif image.mode.startswith('I;16'):
+        depth = 2
+    else:
+        # multi-band and 32 bit images use 4 bytes per pixel in PIL
+        depth = 4
+    return image.size[0] * image.size[1] * depth
+
+
+def has_alpha(image):
+    """
+    Returns True for images with transparency.
+    """
+    return image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+
+
+def make_placeholder(image, size):
+    """
+    Returns compact string representation of image, reduced to not more
+    than size pixels on each side: "WxH:" followed by base64 encoded RGB
+    pixels. Transparent images are placed on background color.
+    """
+    width, height = image.size
+    scale = min(1.0, float(size) / max(width, height))
+    thumb_size = (max(1, int(round(width * scale))),
+        max(1, int(round(height * scale))))
+    if has_alpha(image):
+        image = image.convert('RGBA')
+    elif image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    thumb = image.resize(thumb_size, Image.ANTIALIAS)
+    if thumb.mode == 'RGBA':
+        color = image.info.get('_filter_background_color', '#fff')
+        if isinstance(color, tuple) and len(color) == 4:
+            # background is transparent itself
+            color = '#fff'
+        bg = Image.new('RGB', thumb_size, color)
+        bg.paste(thumb, (0, 0), thumb)
+        thumb = bg
+    else:
+        thumb = thumb.convert('RGB')
+    # tostring was renamed to tobytes in Pillow
+    tobytes = getattr(thumb, 'tobytes', None) or thumb.tostring
+    return '%sx%s:%s' % (thumb_size + (b64encode(tobytes()),))
+
+
+def placeholder_image(placeholder):
+    """
+    Returns small image, stored in placeholder string.
+    """
+    size, data = placeholder.split(':', 1)
+    size = tuple(map(int, size.split('x')))
+    frombytes = getattr(Image, 'frombytes', None) or Image.fromstring
+    return frombytes('RGB', size, b64decode(data))
@@ -1,7 +1,7 @@
 from django.core.management.base import BaseCommand
 
 from imagewallet.fields import WalletField
-from imagewallet.tools import collect_fields, collect_wallets
+from imagewallet.tools import parse_includes, collect_fields, collect_wallets
 from optparse import make_option
 
 
@@ -16,13 +16,7 @@ class Command(BaseCommand):
     )
 
     def handle(self, **options):
-        exports = []
-        for export in options['list']:
-            export = [None if path in ('*', '') else path
-                for path in export.lower().split('.')]
-            exports.append(export + [None] * (3 - len(export)))
-        if not exports:
-            exports = [[None, None, None]]
+        exports = parse_includes(options['list'])
         fields = collect_fields(exports, klass=WalletField)
         formats = options['format'].split(',') if options['format'] else None
         for wallet in collect_wallets(fields):
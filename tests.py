@@ -5,7 +5,59 @@ unittest). These will both pass when you run "manage.py test".
 Replace these with more appropriate tests for your application.
 """
 
+import os
+import random
+import shutil
+import tempfile
+import time
+from base64 import b64encode
+from StringIO import StringIO
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.db import models
+from django.http import Http404
 from django.test import TestCase
+from django.test.client import RequestFactory
+from PIL import Image
+
+from imagewallet import Wallet, Filter, ORIGINAL_FORMAT, filters, background
+from imagewallet.cache import OriginalsCache
+from imagewallet.fields import WalletField
+from imagewallet.image import shared, place, make_placeholder, placeholder_image
+from imagewallet.views import find_wallet, serve_format
+
+
+storage = FileSystemStorage(location=tempfile.mkdtemp(), base_url='/m/')
+
+
+class Photo(models.Model):
+    image = WalletField(storage=storage, null=True, lazy_formats=True,
+        formats={
+            'small': (Filter('resize', (4, 4)), 'JPEG'),
+            'big': (Filter('resize', (6, 6)), 'PNG'),
+        })
+
+    class Meta:
+        app_label = 'imagewallet'
+
+
+def image_file(mode='RGB', size=(8, 8), name='a.png'):
+    buffer = StringIO()
+    Image.new(mode, size).save(buffer, 'PNG')
+    buffer.seek(0)
+    return File(buffer, name=name)
+
+
+class StorageTestCase(TestCase):
+    def tearDown(self):
+        for name in os.listdir(storage.location):
+            path = os.path.join(storage.location, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -21,3 +73,418 @@ Another way to test that 1 + 1 is equal to 2.
 True
 """}
 
+
+
+class PlaceTest(TestCase):
+    def test_inside_image(self):
+        image = Image.new('RGB', (10, 10), (255, 0, 0))
+        image.putpixel((3, 4), (0, 255, 0))
+        result = place(image, (4, 4), (-3, -4))
+        self.assertEqual(result.size, (4, 4))
+        self.assertEqual(result.getpixel((0, 0)), (0, 255, 0))
+        self.assertEqual(result.getpixel((3, 3)), (255, 0, 0))
+
+    def test_background(self):
+        image = Image.new('RGB', (2, 2), (255, 0, 0))
+        image.info['_filter_background_color'] = (0, 0, 255)
+        result = place(image, (4, 2), (1, 0))
+        self.assertEqual(result.size, (4, 2))
+        self.assertEqual(result.getpixel((0, 0)), (0, 0, 255))
+        self.assertEqual(result.getpixel((1, 0)), (255, 0, 0))
+        self.assertEqual(result.getpixel((2, 1)), (255, 0, 0))
+        self.assertEqual(result.getpixel((3, 1)), (0, 0, 255))
+        self.assertFalse(result.info is image.info)
+
+
+class CropTest(TestCase):
+    def setUp(self):
+        self.image = Image.new('L', (10, 20), 0)
+        self.image.putpixel((0, 0), 100)
+        self.image.putpixel((9, 19), 200)
+
+    def test_align_start(self):
+        result = filters.crop(self.image, (4, 5), align=('0%', '0%'))
+        self.assertEqual(result.size, (4, 5))
+        self.assertEqual(result.getpixel((0, 0)), 100)
+
+    def test_align_false(self):
+        result = filters.crop(self.image, (4, 5), align=(False, False))
+        self.assertEqual(result.size, (4, 5))
+        self.assertEqual(result.getpixel((3, 4)), 200)
+
+    def test_align_number(self):
+        result = filters.crop(self.image, (4, 5), align=(-6, -15))
+        self.assertEqual(result.getpixel((3, 4)), 200)
+
+    def test_not_enlarge(self):
+        result = filters.crop(self.image, (40, 50))
+        self.assertEqual(result.size, (10, 20))
+
+
+class SharedImageTest(TestCase):
+    def test_filters_dont_change_shared(self):
+        original = Image.new('RGB', (2, 2), (0, 0, 0))
+        original.info['quality'] = 80
+        result = filters.colorize(shared(original), '#fff', 1)
+        result = filters.quality(result, 50)
+        self.assertEqual(original.getpixel((0, 0)), (0, 0, 0))
+        self.assertEqual(original.info['quality'], 80)
+        self.assertEqual(result.getpixel((0, 0)), (255, 255, 255))
+        self.assertEqual(result.info['quality'], 50)
+
+    def test_convert_same_mode(self):
+        image = Image.new('RGB', (2, 2))
+        self.assertTrue(filters.convert(image, 'RGB') is image)
+
+
+class OriginalsCacheTest(TestCase):
+    def load(self, width):
+        def load():
+            self.loads.append(width)
+            return Image.new('L', (width, 1))
+        return load
+
+    def setUp(self):
+        self.loads = []
+
+    def test_lru(self):
+        cache = OriginalsCache(10)
+        cache.get('a', self.load(4))
+        cache.get('b', self.load(4))
+        # a becomes most recently used, so b is evicted
+        cache.get('a', self.load(4))
+        cache.get('c', self.load(4))
+        self.assertEqual(self.loads, [4, 4, 4])
+        self.assertEqual(cache.size, 8)
+        cache.get('b', self.load(4))
+        self.assertEqual(self.loads, [4, 4, 4, 4])
+
+    def test_memory(self):
+        cache = OriginalsCache(100)
+        cache.put('a', Image.new('RGB', (5, 2)))
+        self.assertEqual(cache.size, 40)
+        cache.put('a', Image.new('L', (5, 2)))
+        self.assertEqual(cache.size, 10)
+        cache.delete('a')
+        self.assertEqual(cache.size, 0)
+
+    def test_too_large(self):
+        cache = OriginalsCache(10)
+        cache.get('a', self.load(4))
+        image = cache.get('b', self.load(20))
+        self.assertEqual(image.size, (20, 1))
+        self.assertEqual(cache.size, 4)
+
+    def test_failed_load(self):
+        cache = OriginalsCache(10)
+        def load():
+            raise IOError()
+        self.assertRaises(IOError, cache.get, 'a', load)
+        self.assertEqual(cache._loading, {})
+
+
+class EncodeToSizeTest(TestCase):
+    def setUp(self):
+        self.wallet = Wallet({ORIGINAL_FORMAT: ()})
+        rand = random.Random(1)
+        self.image = Image.new('RGB', (64, 64))
+        self.image.putdata([(rand.randint(0, 255), rand.randint(0, 255),
+            rand.randint(0, 255)) for _ in xrange(64 * 64)])
+        self.qualities = []
+        encode = self.wallet.encode
+        def tracking_encode(image, image_type, params):
+            self.qualities.append(params.get('quality'))
+            return encode(image, image_type, params)
+        self.wallet.encode = tracking_encode
+
+    def test_fits(self):
+        budget = len(self.wallet.encode(self.image, 'JPEG', {'quality': 50}))
+        limit = filters.MaxFileSize(budget)
+        self.qualities = []
+        data = self.wallet.encode_to_size(self.image, 'JPEG', {'quality': 90}, limit)
+        self.assertTrue(len(data) <= budget)
+        self.assertTrue(1 <= limit.quality < 90)
+        self.assertEqual(self.qualities[0], 90)
+        self.assertTrue(len(self.qualities) <= 7)
+
+    def test_upper_bound_fits(self):
+        limit = filters.MaxFileSize(10 ** 7)
+        self.wallet.encode_to_size(self.image, 'JPEG', {'quality': 80}, limit)
+        self.assertEqual(self.qualities, [80])
+        self.assertEqual(limit.quality, 80)
+
+    def test_hint(self):
+        budget = len(self.wallet.encode(self.image, 'JPEG', {'quality': 50}))
+        limit = filters.MaxFileSize(budget)
+        self.wallet.encode_to_size(self.image, 'JPEG', {'quality': 90}, limit)
+        found = limit.quality
+        self.qualities = []
+        self.wallet.encode_to_size(self.image, 'JPEG', {'quality': 90}, limit)
+        self.assertEqual(self.qualities[:2], [90, found])
+        self.assertTrue(limit.quality >= found)
+
+    def test_nothing_fits(self):
+        limit = filters.MaxFileSize(10)
+        data = self.wallet.encode_to_size(self.image, 'JPEG', {'quality': 90}, limit)
+        self.assertTrue(data)
+        self.assertEqual(limit.quality, None)
+
+
+class WebpTest(StorageTestCase):
+    def setUp(self):
+        self.wallet = Wallet({ORIGINAL_FORMAT: (), 'webp': ('WEBP',)},
+            u'a_%(size)s.%(extension)s', 'PNG', storage=storage)
+
+    def process(self, image):
+        result = self.wallet.process_format('webp', image, save=True)
+        saved = Image.open(storage.path(self.wallet.get_path('webp')))
+        self.assertEqual(saved.format, 'WEBP')
+        return result.mode
+
+    def test_truecolor_modes(self):
+        self.assertEqual(self.process(Image.new('L', (4, 4))), 'RGB')
+        self.assertEqual(self.process(Image.new('P', (4, 4))), 'RGB')
+        self.assertEqual(self.process(Image.new('LA', (4, 4))), 'RGBA')
+
+        image = Image.new('P', (4, 4))
+        image.info['transparency'] = 0
+        self.assertEqual(self.process(image), 'RGBA')
+
+    def test_lossless_only_transparent(self):
+        image = filters.lossless(Image.new('RGB', (4, 4)), only_transparent=True)
+        self.assertFalse('lossless' in image.info)
+        image = filters.lossless(Image.new('LA', (4, 4)), only_transparent=True)
+        self.assertTrue(image.info['lossless'])
+        image = filters.lossless(Image.new('RGB', (4, 4)))
+        self.assertTrue(image.info['lossless'])
+
+
+class WalletParseTest(TestCase):
+    formats = {ORIGINAL_FORMAT: ()}
+    pattern = u'photos/a;b/abc_%(size)s.%(extension)s'
+
+    def test_without_placeholder(self):
+        wallet = Wallet(self.formats, self.pattern, 'JPEG')
+        value = unicode(wallet)
+        self.assertEqual(value, self.pattern + u';JPEG')
+        self.assertEqual(Wallet.parse(value), (self.pattern, 'JPEG', None))
+
+    def test_with_placeholder(self):
+        wallet = Wallet(self.formats, self.pattern, 'PNG',
+            placeholder='2x1:/wAAAP8A')
+        self.assertEqual(Wallet.parse(unicode(wallet)),
+            (self.pattern, 'PNG', '2x1:/wAAAP8A'))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, Wallet.parse, u'no type')
+
+
+class PlaceholderTest(TestCase):
+    def test_round_trip(self):
+        image = Image.new('RGB', (8, 4), (255, 0, 0))
+        placeholder = make_placeholder(image, 4)
+        self.assertEqual(placeholder, '4x2:' + b64encode('\xff\x00\x00' * 8))
+        restored = placeholder_image(placeholder)
+        self.assertEqual(restored.size, (4, 2))
+        self.assertEqual(restored.getpixel((3, 1)), (255, 0, 0))
+
+    def test_palette(self):
+        image = Image.new('P', (3, 9))
+        self.assertTrue(make_placeholder(image, 4).startswith('1x4:'))
+
+    def test_transparent(self):
+        white = b64encode('\xff' * 3 * 4)
+        image = Image.new('LA', (2, 2), (0, 0))
+        self.assertEqual(make_placeholder(image, 4), '2x2:' + white)
+
+        image = Image.new('P', (2, 2), 0)
+        image.putpalette([0, 0, 0] * 256)
+        image.info['transparency'] = 0
+        self.assertEqual(make_placeholder(image, 4), '2x2:' + white)
+
+        image = Image.new('RGBA', (2, 2), (0, 0, 0, 0))
+        image.info['_filter_background_color'] = '#f00'
+        self.assertEqual(make_placeholder(image, 4),
+            '2x2:' + b64encode('\xff\x00\x00' * 4))
+
+    def test_color(self):
+        wallet = Wallet({ORIGINAL_FORMAT: ()}, u'a_%(size)s.%(extension)s',
+            'JPEG', placeholder='1x1:' + b64encode('\x33\x66\x99'))
+        self.assertEqual(wallet.placeholder_color, '#336699')
+        self.assertTrue(wallet.placeholder_url.startswith('data:image/png;base64,'))
+
+
+class ParseFilenameTest(TestCase):
+    def setUp(self):
+        self.field = WalletField(upload_to='photos/%Y',
+            formats={'big_thumb': ('JPEG',)})
+        self.pattern = u'photos/2012/' + self.field.get_filename(u'a.jpg')
+
+    def test_formats(self):
+        for format in ('big_thumb', ORIGINAL_FORMAT):
+            path = self.pattern % {'size': format, 'extension': 'jpg'}
+            self.assertEqual(self.field.parse_filename(path),
+                (self.pattern, format))
+
+    def test_without_dir(self):
+        pattern = self.field.get_filename(u'a.jpg')
+        path = pattern % {'size': 'big_thumb', 'extension': 'png'}
+        self.assertEqual(self.field.parse_filename(path), (pattern, 'big_thumb'))
+
+    def test_empty_upload_to(self):
+        field = WalletField(storage=storage, formats={'small': ('JPEG',)})
+        pattern = field.generate_filename(None, u'a.jpg')
+        self.assertFalse(pattern.startswith('./'))
+        path = pattern % {'size': 'small', 'extension': 'jpg'}
+        self.assertEqual(field.parse_filename(path), (pattern, 'small'))
+        self.assertEqual(field.parse_filename('./' + path), (pattern, 'small'))
+
+    def test_bad_paths(self):
+        path = self.pattern % {'size': 'big_thumb', 'extension': 'jpg'}
+        for bad in (
+                path.replace('big_thumb', 'unknown'),
+                'photos/abc_big_thumb.jpg',
+                path[:-4],
+                '../' + path,
+                'photos/../' + path,
+                '/' + path,
+                ):
+            self.assertEqual(self.field.parse_filename(bad), None, bad)
+
+
+class ServeFormatTest(StorageTestCase):
+    def setUp(self):
+        self.photo = Photo.objects.create()
+        self.photo.image = image_file()
+        self.photo.save()
+        self.field = Photo._meta.get_field('image')
+
+    def test_serve(self):
+        url = self.photo.image.url_small
+        self.assertTrue(url.startswith('/m/'))
+        path = url[len('/m/'):]
+        self.assertFalse(storage.exists(path))
+        response = serve_format(RequestFactory().get(url), path,
+            fields=['imagewallet.photo.image'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertTrue(storage.exists(path))
+
+    def test_dot_prefixed_pattern(self):
+        pattern = self.photo.image.pattern
+        Photo.objects.filter(pk=self.photo.pk) \
+            .update(image=u'./' + unicode(self.photo.image))
+        path = pattern % {'size': 'small', 'extension': 'jpg'}
+        wallet, format = find_wallet(path, [self.field])
+        self.assertEqual(format, 'small')
+        self.assertEqual(wallet.pattern, u'./' + pattern)
+
+    def test_not_found(self):
+        path = self.photo.image.pattern % {'size': 'small', 'extension': 'png'}
+        self.assertEqual(find_wallet(path, [self.field]), (None, None))
+        self.assertRaises(Http404, serve_format, RequestFactory().get('/m/'),
+            'abcdefghij12_small.jpg')
+
+
+class BackgroundTest(StorageTestCase):
+    def setUp(self):
+        self.photo = Photo.objects.create()
+        self.photo.image = image_file()
+        self.photo.save()
+
+    def test_decode_once(self):
+        image = self.photo.image
+        wallet = Wallet(image.formats, image.pattern, image.original_image_type,
+            storage=storage)
+        opened = []
+        open_original = wallet.open_original
+        def counting_open_original(path):
+            opened.append(path)
+            return open_original(path)
+        wallet.open_original = counting_open_original
+
+        process_format = wallet.process_format
+        def waiting_process_format(*args, **kwargs):
+            # wait until both operations are holding original
+            for _ in xrange(500):
+                with background._wallets_lock:
+                    state = background._wallets.get(wallet)
+                    if state and state[1] == 2:
+                        break
+                time.sleep(0.01)
+            return process_format(*args, **kwargs)
+        wallet.process_format = waiting_process_format
+
+        url = background.get_url(wallet, 'small')
+        size = background.get_size(wallet, 'big')
+        self.assertTrue(url.get(10).endswith('_small.jpg'))
+        self.assertEqual(size.get(10), (6, 6))
+        self.assertEqual(len(opened), 1)
+        self.assertFalse(wallet._loaded_original)
+        self.assertFalse(wallet in background._wallets)
+
+    def test_save_without_instance(self):
+        photo = Photo.objects.create()
+        wallet = photo.image
+        wallet.pattern = wallet.field.generate_filename(photo, u'a.png')
+        background.save(wallet, image_file()).get(10)
+        self.assertTrue(wallet)
+        self.assertTrue(Photo.objects.filter(pk=photo.pk, image=None).exists())
+
+
+class BulkSaveTest(StorageTestCase):
+    def setUp(self):
+        self.field = Photo._meta.get_field('image')
+        self.photos = [Photo.objects.create() for _ in xrange(3)]
+
+    def saved(self, photo):
+        return Photo.objects.get(pk=photo.pk).image
+
+    def test_failed_item(self):
+        first, second, third = self.photos
+        failures = self.field.bulk_save([(first, image_file()),
+            (second, 'missing.png'), (third, image_file())], batch_size=3)
+        self.assertEqual(len(failures), 1)
+        self.assertTrue(failures[0][0] is second)
+        self.assertTrue(isinstance(failures[0][1], IOError))
+        self.assertTrue(self.saved(first))
+        self.assertFalse(self.saved(second))
+        self.assertTrue(self.saved(third))
+        self.assertFalse(second.image)
+
+    def test_small_batches(self):
+        failures = self.field.bulk_save([(photo, image_file())
+            for photo in self.photos], workers=2, batch_size=2)
+        self.assertEqual(failures, [])
+        for photo in self.photos:
+            self.assertEqual(unicode(self.saved(photo)), unicode(photo.image))
+            self.assertFalse(photo.image._loaded_original)
+
+    def test_deleted_row(self):
+        photo = self.photos[0]
+        Photo.objects.filter(pk=photo.pk).delete()
+        failures = self.field.bulk_save([(photo, image_file())])
+        self.assertEqual(len(failures), 1)
+        self.assertTrue(isinstance(failures[0][1], Photo.DoesNotExist))
+        self.assertFalse(photo.image)
+        self.assertEqual(os.listdir(storage.location), [])
+
+    def test_failed_transaction(self):
+        first, second = self.photos[:2]
+        pre_save = self.field.pre_save
+        def failing_pre_save(instance, add):
+            if instance is second:
+                raise ValueError("Write failed.")
+            return pre_save(instance, add)
+        self.field.pre_save = failing_pre_save
+        try:
+            failures = self.field.bulk_save([(first, image_file()),
+                (second, image_file())])
+        finally:
+            del self.field.pre_save
+        self.assertEqual(set(instance for instance, error in failures),
+            set([first, second]))
+        # first update rolled back with whole batch
+        self.assertFalse(self.saved(first))
+        self.assertFalse(first.image)
+        self.assertEqual(os.listdir(storage.location), [])
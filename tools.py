@@ -6,6 +6,22 @@ from django.db.models import Q
 from imagewallet import Wallet
 
 
+def parse_includes(includes):
+    """
+    Converts list of "app", "app.model" or "app.model.field" strings to
+    list of [app, model, field] for collect_fields. Empty list and "*"
+    parts mean any.
+    """
+    result = []
+    for include in includes:
+        include = [None if part in ('*', '') else part
+            for part in include.lower().split('.')]
+        result.append(include + [None] * (3 - len(include)))
+    if not result:
+        result = [[None, None, None]]
+    return result
+
+
 def collect_fields(includes=[], klass=None):
     for app in get_apps():
         app_name = app.__name__.split('.')[-2].lower()
@@ -29,5 +45,6 @@ def collect_wallets(fields, klass=Wallet):
             exclude = exclude | Q(**{field.name: ''})
         items = model._default_manager.exclude(exclude).values(model._meta.pk.name, field.name)
         for item in items:
-            pattern, format = item.get(field.name).rsplit(';', 1)
-            yield klass(field.formats, pattern, format, storage=field.storage)
\ No newline at end of file
+            pattern, format, placeholder = klass.parse(item.get(field.name))
+            yield klass(field.formats, pattern, format, storage=field.storage,
+                placeholder=placeholder)
\ No newline at end of file
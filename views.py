@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+from django.db.models import Q
+from django.http import HttpResponse, Http404
+from django.utils.cache import patch_cache_control
+
+from imagewallet import Wallet, ORIGINAL_FORMAT
+from imagewallet.fields import WalletField
+from imagewallet.tools import parse_includes, collect_fields
+
+
+def find_wallet(path, fields):
+    """
+    Returns wallet and format for storage path of not-original format
+    of any saved wallet in given fields. Returns (None, None) if nothing
+    found.
+    """
+    for field in fields:
+        parsed = field.parse_filename(path)
+        if not parsed:
+            continue
+        pattern, format = parsed
+        if format == ORIGINAL_FORMAT:
+            continue
+        # wallets saved with empty upload_to before may start with "./"
+        lookup = Q(**{field.name + '__startswith': pattern + ';'})
+        if '/' not in pattern:
+            lookup |= Q(**{field.name + '__startswith': './' + pattern + ';'})
+        values = field.model._default_manager.filter(lookup) \
+            .values_list(field.name, flat=True)[:1]
+        for value in values:
+            pattern, original_image_type, placeholder = Wallet.parse(value)
+            wallet = Wallet(field.formats, pattern, original_image_type,
+                storage=field.storage, originals_cache=field.originals_cache,
+                placeholder=placeholder)
+            # extension should match format type
+            if os.path.normpath(wallet.get_path(format)) == os.path.normpath(path):
+                return wallet, format
+    return None, None
+
+
+def serve_format(request, path, fields=None, sendfile_header=None,
+        max_age=365 * 24 * 60 * 60):
+    """
+    Creates missing image of wallet format and returns it. Designed for
+    fields with lazy_formats, which don't create formats on render.
+    Should be used as fallback for not found files in web server, path
+    is path in fields storage.
+
+    fields is list of "app", "app.model" or "app.model.field" strings,
+    all wallet fields used by default. If sendfile_header is given, file
+    is not read and only header is returned: file system path for
+    "X-Sendfile" and storage url for others, like "X-Accel-Redirect".
+    Files of not local storages are always read for "X-Sendfile".
+    """
+    fields = collect_fields(parse_includes(fields or []), klass=WalletField)
+    wallet, format = find_wallet(path, fields)
+    if wallet is None:
+        raise Http404("Image not found.")
+
+    if wallet.needs_processing(format):
+        wallet.process_format(format, save=True)
+        wallet.release_original()
+
+    content_type = 'image/' + wallet.get_image_type(format).lower()
+    local_path = wallet.get_local_path(path)
+    if sendfile_header == 'X-Sendfile' and local_path is not None:
+        response = HttpResponse(content_type=content_type)
+        response[sendfile_header] = local_path
+    elif sendfile_header and sendfile_header != 'X-Sendfile':
+        response = HttpResponse(content_type=content_type)
+        response[sendfile_header] = wallet.storage.url(path)
+    else:
+        file = wallet.storage.open(path)
+        try:
+            response = HttpResponse(file.read(), content_type=content_type)
+        finally:
+            file.close()
+    patch_cache_control(response, public=True, max_age=max_age)
+    return response